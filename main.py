@@ -4,15 +4,25 @@
 # 导入标准库
 import random
 import time
-import traceback
 import json
 import os
+import copy
+import sys
+import hashlib
+import tempfile
 from datetime import datetime
 import zoneinfo
 import asyncio
+import contextlib
+import functools
+from typing import Any
 
 # 导入第三方库
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+try:
+    # orjson 为可选的加速依赖，缺失时回退到标准库 json
+    import orjson
+except ImportError:
+    orjson = None
 
 # 导入 AstrBot 的核心 API 和组件
 import astrbot.api.star as star
@@ -24,51 +34,165 @@ from astrbot.core.message.components import Record, Plain
 
 # --- 全局常量定义 ---
 
-# 修复：使用与插件名一致的、唯一的持久化文件名，以避免与其他插件产生潜在的命名冲突
+# 修复：使用与插件名一致的、唯一的持久化目录名，以避免与其他插件产生潜在的命名冲突
 # 这是高质量开源插件开发的最佳实践
-SESSION_DATA_FILE = os.path.join(
+# 每个会话单独保存为一个分片文件，修改一个会话时只需重写它自己的文件
+SESSION_DATA_DIR = os.path.join(
+    get_astrbot_data_path(), "astrbot_plugin_proactive_chat_data"
+)
+# 旧版本使用的单一数据文件，仅用于迁移
+LEGACY_SESSION_DATA_FILE = os.path.join(
     get_astrbot_data_path(), "astrbot_plugin_proactive_chat_data.json"
 )
 
+# 时间戳字段的变化小于该阈值 (秒) 时视为无实质变化，不单独触发写盘
+TIMESTAMP_TOLERANCE = 60
+TIMESTAMP_FIELDS = ("last_msg_time", "next_trigger_time")
+
+# 会话数据中保存 "用户 ID -> 会话 ID 列表" 索引的保留键
+SESSION_INDEX_KEY = "__index__"
+
+# 插件终止时等待正在执行的主动聊天完成的最长时间 (秒)
+SHUTDOWN_WAIT_TIMEOUT = 10
+
+# TTS Provider 缓存的有效期 (秒)
+TTS_PROVIDER_CACHE_TTL = 300
+
+# 动机 Prompt 中未回复次数的占位符，以及常见计数值的字符串缓存
+UNANSWERED_COUNT_PLACEHOLDER = "{{unanswered_count}}"
+COUNT_STRS = tuple(str(i) for i in range(100))
+
 # --- 工具函数 ---
 
 
+def loads_json(raw: str | bytes):
+    """解析 JSON 数据。"""
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+
+def get_session_file(session_id: str) -> str:
+    """获取会话对应的分片文件路径。会话 ID 含有冒号等字符，因此使用其哈希作为文件名。"""
+    file_name = hashlib.sha1(session_id.encode("utf-8")).hexdigest() + ".json"
+    return os.path.join(SESSION_DATA_DIR, file_name)
+
+
 def load_session_data_from_file() -> dict:
-    """从文件中加载会话数据。"""
-    if os.path.exists(SESSION_DATA_FILE):
+    """从分片文件中加载全部会话数据。"""
+    data = {}
+    if not os.path.isdir(SESSION_DATA_DIR):
+        return data
+    for file_name in os.listdir(SESSION_DATA_DIR):
+        if file_name.endswith(".tmp"):
+            # 上次运行在写入途中退出时遗留的临时文件，其内容从未生效，直接清理
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(SESSION_DATA_DIR, file_name))
+            continue
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(SESSION_DATA_DIR, file_name), "rb") as f:
+                shard = loads_json(f.read())
+            data[shard["session_id"]] = shard["data"]
+        except Exception:
+            # 如果分片无法解析，跳过它以防止程序崩溃
+            logger.warning(f"[主动消息] 无法解析会话数据分片 {file_name}，已跳过。")
+    return data
+
+
+def load_legacy_session_data() -> dict:
+    """从旧版本的单一数据文件中加载会话数据。"""
+    if os.path.exists(LEGACY_SESSION_DATA_FILE):
         try:
-            with open(SESSION_DATA_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(LEGACY_SESSION_DATA_FILE, "rb") as f:
+                return loads_json(f.read())
         except Exception:
             # 如果文件存在但无法解析，返回空字典以防止程序崩溃
             return {}
     return {}
 
 
-def save_session_data_to_file(data: dict):
-    """将会话数据保存到文件。"""
+def dump_session_data(data: dict) -> bytes:
+    """将会话数据序列化为 UTF-8 编码的 JSON。"""
+    # 保留缩进和非 ASCII 字符，保证 JSON 文件的可读性
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+
+
+def save_session_to_file(session_id: str, session_info) -> bool:
+    """将单个会话的数据保存到它的分片文件，返回是否保存成功。"""
+    tmp_path = None
     try:
-        # 使用 indent=4 和 ensure_ascii=False 来保证 JSON 文件的可读性
-        with open(SESSION_DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        os.makedirs(SESSION_DATA_DIR, exist_ok=True)
+        # 先写入临时文件再原子替换，避免写入中途崩溃导致数据文件损坏。
+        # 每次写入都使用独立的临时文件，避免多个写入者同时截断同一个文件。
+        # mkstemp 创建的文件权限为 0600，替换后分片文件仅对运行 AstrBot 的用户可读写
+        fd, tmp_path = tempfile.mkstemp(dir=SESSION_DATA_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(dump_session_data({"session_id": session_id, "data": session_info}))
+        os.replace(tmp_path, get_session_file(session_id))
+        return True
     except Exception as e:
-        logger.error(f"[主动消息] 保存会话数据失败: {e}")
+        logger.error(f"[主动消息] 保存会话 {session_id} 的数据失败: {e}")
+        if tmp_path:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+        return False
 
 
-def is_quiet_time(quiet_hours_str: str, tz: zoneinfo.ZoneInfo) -> bool:
-    """检查当前时间是否处于免打扰时段。"""
+def save_sessions_to_file(sessions: dict) -> list:
+    """将多个会话的数据分别保存到各自的分片文件，返回实际保存成功的会话 ID。"""
+    written = []
+    # 索引分片总是最先写入：若写到一半进程退出，索引中多出的会话在启动时会被跳过，
+    # 而缺失的会话则再也不会被补回索引。因此索引写入失败时，本批次的其余会话也暂不写入
+    if SESSION_INDEX_KEY in sessions:
+        if not save_session_to_file(SESSION_INDEX_KEY, sessions[SESSION_INDEX_KEY]):
+            return written
+        written.append(SESSION_INDEX_KEY)
+    for session_id, session_info in sessions.items():
+        if session_id != SESSION_INDEX_KEY and save_session_to_file(
+            session_id, session_info
+        ):
+            written.append(session_id)
+    return written
+
+
+def is_session_changed(old, new) -> bool:
+    """比较会话数据与上次落盘时的快照，判断是否存在需要写盘的实质变化。"""
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return old != new
+    if old.keys() != new.keys():
+        return True
+    for key, value in new.items():
+        if key in TIMESTAMP_FIELDS:
+            if abs(value - old[key]) > TIMESTAMP_TOLERANCE:
+                return True
+        elif value != old[key]:
+            return True
+    return False
+
+
+def parse_quiet_hours(quiet_hours_str: str):
+    """解析免打扰时段配置，返回 (开始小时, 结束小时)，格式错误时返回 None。"""
     try:
         start_str, end_str = quiet_hours_str.split("-")
-        start_hour, end_hour = int(start_str), int(end_str)
-        now = datetime.now(tz) if tz else datetime.now()
-        # 处理跨天的情况 (例如 23-7)
-        if start_hour <= end_hour:
-            return start_hour <= now.hour < end_hour
-        else:
-            return now.hour >= start_hour or now.hour < end_hour
+        return int(start_str), int(end_str)
     except Exception:
-        # 如果配置格式错误，默认为非免打扰时段
+        return None
+
+
+def is_quiet_time(quiet_hours, tz: zoneinfo.ZoneInfo) -> bool:
+    """检查当前时间是否处于已解析的免打扰时段。"""
+    # 如果配置格式错误，默认为非免打扰时段
+    if not quiet_hours:
         return False
+    start_hour, end_hour = quiet_hours
+    hour = (datetime.now(tz) if tz else datetime.now()).hour
+    # 处理跨天的情况 (例如 23-7)
+    if start_hour <= end_hour:
+        return start_hour <= hour < end_hour
+    else:
+        return hour >= start_hour or hour < end_hour
 
 
 # --- 插件主类 ---
@@ -93,88 +217,253 @@ class Main(star.Star):
         """
         super().__init__(context)
         self.config = config  # 插件的配置对象，从 _conf_schema.json 读取
-        self.scheduler = None  # 定时任务调度器实例
+        self._tasks: dict[str, asyncio.Task] = {}  # 各会话仍在等待中的定时任务，每个会话至多一个
+        self._running_tasks: set[asyncio.Task] = set()  # 已开始执行 check_and_chat 的任务
         self.timezone = None  # 时区信息
+        self._rng = random.Random()  # 插件独立的随机数生成器，不与其他插件共享全局状态
         self.session_data = load_session_data_from_file()  # 从文件加载持久化的会话数据
+        self._saved_snapshots = copy.deepcopy(self.session_data)  # 上次落盘时的数据快照
+        if not self.session_data:
+            # 兼容旧版本的单一数据文件：读入后在首次写盘时拆分为分片文件
+            self.session_data = load_legacy_session_data()
+        self._dirty_sessions = set()  # 存在未落盘修改的会话
+        self._dirty = asyncio.Event()  # 会话数据是否存在尚未落盘的修改
+        self._flush_interval = 5.0  # 后台合并写盘的间隔 (秒)
+        self._flush_task = None  # 后台写盘任务
+        self._pending_write = None  # 正在线程池中执行的写盘操作
+        self._history_cache: dict[str, tuple[tuple, list]] = {}  # 各会话当前对话历史的解析缓存
+        self._tts_cache: dict[str, tuple[float, Any]] = {}  # 各会话的 TTS Provider 缓存
+        self._reload_cached_config()  # 预先读取热路径上需要的配置项
         logger.info("[主动消息] 插件实例已创建。")
 
     async def initialize(self):
         """
         插件的异步初始化函数。
         在 AstrBot 的主事件循环准备好后被调用。
-        这是创建和启动异步任务（如 APScheduler）的正确位置。
+        这是创建和启动异步任务（如定时任务）的正确位置。
         """
         try:
             # 从 AstrBot 主配置中获取时区设置
+            # 构造时区时即已载入 tzdata；再计算一次当前时间，完成剩余的预热，
+            # 避免首次在定时任务中计算当前时间时才做这些工作
             self.timezone = zoneinfo.ZoneInfo(self.context.get_config().get("timezone"))
+            datetime.now(self.timezone)
         except Exception:
             self.timezone = None
 
-        # 创建一个独立的、属于本插件的异步调度器实例
-        self.scheduler = AsyncIOScheduler(timezone=self.timezone)
-        self.scheduler.start()
+        # 启动后台写盘任务，合并短时间内的多次修改，避免每条消息都重写整个文件
+        self._flush_task = asyncio.create_task(self._flusher())
+        # 尚无分片文件的会话 (例如从旧版本数据文件迁移而来) 会在此被标记为待写盘
+        for session_id in self.session_data:
+            self._mark_dirty(session_id)
 
         # 从持久化数据中恢复因重启而中断的定时任务
         await self._init_jobs_from_data()
-        logger.info("[主动消息] 调度器已初始化。")
+        logger.info("[主动消息] 定时任务已初始化。")
+
+    def _mark_dirty(self, session_id: str):
+        """标记会话数据已修改，由后台任务统一落盘。仅时间戳的微小变化不会触发写盘。"""
+        if is_session_changed(
+            self._saved_snapshots.get(session_id), self.session_data.get(session_id)
+        ):
+            self._dirty_sessions.add(session_id)
+            self._dirty.set()
+
+    async def _flusher(self):
+        """
+        后台写盘任务。
+        收到修改标记后再等待一个合并间隔，期间每个会话的所有修改只会写一次它的分片文件。
+        """
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(self._flush_interval)
+            self._dirty.clear()
+            dirty_sessions, self._dirty_sessions = self._dirty_sessions, set()
+            # 写盘前再比较一次，合并间隔内被改回原值的会话无需写盘。
+            # 同时在事件循环中复制一份快照，再交给线程池写盘，避免阻塞事件循环，
+            # 并防止写盘线程遍历字典时字典被其他协程修改
+            snapshot = {
+                session_id: copy.deepcopy(self.session_data[session_id])
+                for session_id in dirty_sessions
+                if is_session_changed(
+                    self._saved_snapshots.get(session_id),
+                    self.session_data.get(session_id),
+                )
+            }
+            if not snapshot:
+                continue
+            self._pending_write = asyncio.ensure_future(
+                asyncio.to_thread(save_sessions_to_file, snapshot)
+            )
+            # 写盘完成后再更新快照；即使本任务在等待期间被取消，回调也会照常执行
+            self._pending_write.add_done_callback(
+                functools.partial(self._on_write_done, snapshot)
+            )
+            # 取消本任务无法中断已交给线程池的写盘，因此用 shield 保护它，由 terminate 等待其完成
+            await asyncio.shield(self._pending_write)
+
+    def _on_write_done(self, snapshot: dict, write: asyncio.Future):
+        """后台写盘完成后，只为实际写入成功的会话更新快照，失败的会话重新标记为待写盘。"""
+        written = (
+            write.result() if not write.cancelled() and not write.exception() else []
+        )
+        for session_id in written:
+            self._saved_snapshots[session_id] = snapshot[session_id]
+        failed = snapshot.keys() - set(written)
+        if failed:
+            self._dirty_sessions.update(failed)
+            self._dirty.set()
+
+    def _reload_cached_config(self):
+        """
+        一次性读取并缓存各分组中的配置项，避免在每条消息和每次调度时重复解析。
+        在 WebUI 中修改配置后 AstrBot 会重载插件，缓存随之重建；
+        如需在运行时手动修改 self.config，修改后应再次调用本方法。
+        """
+        basic_conf = self.config.get("basic_settings", {})
+        schedule_conf = self.config.get("schedule_settings", {})
+        tts_conf = self.config.get("tts_settings", {})
+        prompt_conf = self.config.get("prompt_settings", {})
+
+        self._enable: bool = bool(basic_conf.get("enable", False))
+        # 驻留字符串，使每条私聊消息上的发送者比较尽可能廉价
+        self._target_user_id: str = sys.intern(
+            str(basic_conf.get("target_user_id", "")).strip()
+        )
+        self._min_interval_s: int = (
+            int(schedule_conf.get("min_interval_minutes", 30)) * 60
+        )
+        self._max_interval_s: int = max(
+            self._min_interval_s,
+            int(schedule_conf.get("max_interval_minutes", 900)) * 60,
+        )
+        self._quiet_hours = parse_quiet_hours(schedule_conf.get("quiet_hours", "1-7"))
+        self._motivation_template: str = prompt_conf.get("proactive_prompt", "")
+        # 预先按占位符切分模板，生成 Prompt 时只需拼接
+        self._prompt_parts = self._motivation_template.split(
+            UNANSWERED_COUNT_PLACEHOLDER
+        )
+        self._always_send_text: bool = bool(tts_conf.get("always_send_text", True))
+
+    def _parse_history(self, session_id: str, conv_id: str, history: str) -> list:
+        """解析对话历史 JSON，历史未变化时直接复用上次的解析结果。"""
+        # 以对话 ID、长度和首尾片段作为廉价的签名，避免每次都完整解析数十 KB 的历史。
+        # 缓存按会话存放，切换对话后旧对话的历史会被替换，而不是一直留在内存中
+        sig = (conv_id, len(history), hash(history[:64] + history[-64:]))
+        cached = self._history_cache.get(session_id)
+        if cached and cached[0] == sig:
+            parsed = cached[1]
+        else:
+            parsed = loads_json(history)
+            self._history_cache[session_id] = (sig, parsed)
+        # 返回浅拷贝，防止下游修改列表时污染缓存
+        return list(parsed)
+
+    def _get_session_info(self, session_id: str) -> dict:
+        """获取会话数据，不存在时创建。只查找一次外层字典，且不会预先分配用完即弃的空字典。"""
+        session_info = self.session_data.get(session_id)
+        if session_info is None:
+            session_info = self.session_data[session_id] = {}
+        return session_info
+
+    def _index_session(self, user_id: str, session_id: str):
+        """将会话登记到用户索引中，供启动时快速恢复定时任务。"""
+        index = self.session_data.get(SESSION_INDEX_KEY)
+        if index is None:
+            index = self.session_data[SESSION_INDEX_KEY] = {}
+        session_ids = index.get(user_id)
+        if session_ids is None:
+            session_ids = index[user_id] = []
+        if session_id not in session_ids:
+            session_ids.append(session_id)
+            self._mark_dirty(SESSION_INDEX_KEY)
+
+    def _get_tts_provider(self, session_id: str):
+        """获取会话使用的 TTS Provider，结果会缓存一段时间。"""
+        now = time.monotonic()
+        cached = self._tts_cache.get(session_id)
+        if cached and now - cached[0] <= TTS_PROVIDER_CACHE_TTL:
+            return cached[1]
+        tts_provider_or_list = self.context.get_using_tts_provider(umo=session_id)
+        tts_provider = (
+            tts_provider_or_list[0]
+            if isinstance(tts_provider_or_list, list) and tts_provider_or_list
+            else tts_provider_or_list
+        )
+        self._tts_cache[session_id] = (now, tts_provider)
+        return tts_provider
 
     async def _init_jobs_from_data(self):
         """从文件中恢复定时任务。"""
-        # 修复：从新的 "basic_settings" 分组中读取核心配置
-        basic_conf = self.config.get("basic_settings", {})
-        target_user_id = str(basic_conf.get("target_user_id", "")).strip()
+        target_user_id = self._target_user_id
         if not target_user_id:
             return
 
-        for session_id, session_info in self.session_data.items():
-            # 确保只恢复属于目标用户的私聊任务
-            if f":{target_user_id}" in session_id and "private" in session_id:
-                next_trigger = session_info.get("next_trigger_time", 0)
-                # 如果任务的预定执行时间还没到，就重新安排它
-                if time.time() < next_trigger:
-                    run_date = datetime.fromtimestamp(next_trigger)
-                    self.scheduler.add_job(
-                        self.check_and_chat,
-                        "date",
-                        run_date=run_date,
-                        args=[session_id],
-                        id=session_id,
-                        replace_existing=True,
-                        misfire_grace_time=60,  # 允许任务在错过触发时间后 60 秒内依然执行
-                    )
+        index = self.session_data.get(SESSION_INDEX_KEY)
+        if index is None:
+            index = self.session_data[SESSION_INDEX_KEY] = {}
+        if target_user_id not in index:
+            # 旧版本的数据文件没有索引，扫描一次并补建。
+            # 会话数据只会由私聊监听写入，因此只需按用户 ID 匹配会话 ID 的结尾
+            index[target_user_id] = [
+                session_id
+                for session_id in self.session_data
+                if session_id.endswith(f":{target_user_id}")
+            ]
+            self._mark_dirty(SESSION_INDEX_KEY)
+
+        # 只遍历属于目标用户的会话，无需扫描全部会话数据
+        for session_id in index.get(target_user_id, []):
+            session_info = self.session_data.get(session_id)
+            if not session_info:
+                continue
+            next_trigger = session_info.get("next_trigger_time", 0)
+            # 如果任务的预定执行时间还没到，就按剩余时长重新安排它。
+            # 墙上时间只在此处换算一次，之后的等待都基于单调时钟
+            delay = next_trigger - time.time()
+            if delay > 0:
+                self._start_chat_task(session_id, delay)
+
+    def _start_chat_task(self, session_id: str, delay: float):
+        """为会话启动定时任务，并替换该会话仍在等待中的任务。"""
+        old_task = self._tasks.get(session_id)
+        if old_task:
+            old_task.cancel()
+        self._tasks[session_id] = asyncio.create_task(
+            self._chat_loop(session_id, delay)
+        )
+
+    async def _chat_loop(self, session_id: str, delay: float):
+        """等待指定的秒数后触发一次主动聊天。"""
+        await asyncio.sleep(delay)
+        # 等待结束后即移出等待队列：已开始执行的主动聊天不会再被重新调度取消，
+        # 以免在发送途中被打断 (与 APScheduler 不会取消正在运行的任务的行为一致)
+        task = asyncio.current_task()
+        if self._tasks.get(session_id) is task:
+            del self._tasks[session_id]
+        self._running_tasks.add(task)
+        task.add_done_callback(self._running_tasks.discard)
+        await self.check_and_chat(session_id)
 
     async def _schedule_next_chat(self, session_id: str):
         """安排下一次主动聊天的定时任务。"""
-        # 修复：从分组后的配置中正确读取参数
-        schedule_conf = self.config.get("schedule_settings", {})
-        min_interval = int(schedule_conf.get("min_interval_minutes", 30)) * 60
-        max_interval = max(
-            min_interval, int(schedule_conf.get("max_interval_minutes", 900)) * 60
+        random_interval = self._rng.randrange(
+            self._min_interval_s, self._max_interval_s + 1
         )
-        random_interval = random.randint(min_interval, max_interval)
 
+        # 定时任务直接按间隔等待 (asyncio 使用单调时钟，不受系统时间跳变影响)，
+        # 墙上时间只用于持久化，以便重启后恢复
         next_trigger_time = time.time() + random_interval
-        run_date = datetime.fromtimestamp(next_trigger_time)
-
-        # 添加一个新的定时任务
-        self.scheduler.add_job(
-            self.check_and_chat,
-            "date",
-            run_date=run_date,
-            args=[session_id],
-            id=session_id,
-            replace_existing=True,  # 如果已存在同名任务，则替换
-            misfire_grace_time=60,
-        )
+
+        # 启动新的定时任务，如果已存在该会话的任务，则替换
+        self._start_chat_task(session_id, random_interval)
 
         # 更新持久化数据
-        self.session_data.setdefault(session_id, {})["next_trigger_time"] = (
-            next_trigger_time
-        )
-        save_session_data_to_file(self.session_data)
+        self._get_session_info(session_id)["next_trigger_time"] = next_trigger_time
+        self._mark_dirty(session_id)
         # 修复：优化日志输出，使其更直观
         logger.info(
-            f"[主动消息] 已为会话 {session_id} 安排下一次主动聊天，时间：{run_date.strftime('%Y-%m-%d %H:%M:%S')}。"
+            f"[主动消息] 已为会话 {session_id} 安排下一次主动聊天，时间：{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(next_trigger_time))}。"
         )
 
     @filter.event_message_type(filter.EventMessageType.PRIVATE_MESSAGE, priority=999)
@@ -183,19 +472,21 @@ class Main(star.Star):
         监听所有私聊消息。
         这是我们重置计时器和计数器的入口。
         """
-        # 修复：从新的 "basic_settings" 分组中读取核心配置
-        basic_conf = self.config.get("basic_settings", {})
-        if not basic_conf.get("enable", False):
-            return
-
-        target_user_id = str(basic_conf.get("target_user_id", "")).strip()
-        if not target_user_id or event.get_sender_id() != target_user_id:
+        # 先用缓存的配置过滤掉无关消息，再触碰会话数据
+        if (
+            not self._enable
+            or not self._target_user_id
+            or event.get_sender_id() != self._target_user_id
+        ):
             return
 
         # 当目标用户回复时，重置未回复计数器，并重新安排下一次主动聊天
         session_id = event.unified_msg_origin
-        self.session_data.setdefault(session_id, {})["unanswered_count"] = 0
-        self.session_data[session_id]["last_msg_time"] = time.time()
+        if session_id not in self.session_data:
+            self._index_session(self._target_user_id, session_id)
+        session_info = self._get_session_info(session_id)
+        session_info["unanswered_count"] = 0
+        session_info["last_msg_time"] = time.time()
         await self._schedule_next_chat(session_id)
         logger.info(f"[主动消息] 用户已回复。会话 {session_id} 的未回复计数已重置。")
 
@@ -206,14 +497,8 @@ class Main(star.Star):
         """
         logger.info(f"[主动消息] 定时任务触发，会话ID: '{session_id}'。")
         try:
-            # 修复：从新的 "basic_settings" 分组中读取核心配置
-            basic_conf = self.config.get("basic_settings", {})
-            schedule_conf = self.config.get("schedule_settings", {})
-
             # 检查插件是否启用和是否处于免打扰时段
-            if not basic_conf.get("enable", False) or is_quiet_time(
-                schedule_conf.get("quiet_hours", "1-7"), self.timezone
-            ):
+            if not self._enable or is_quiet_time(self._quiet_hours, self.timezone):
                 logger.info(
                     "[主动消息] 插件被禁用或当前为免打扰时段，跳过本次任务并重新调度。"
                 )
@@ -221,8 +506,10 @@ class Main(star.Star):
                 return
 
             # 读取当前的未回复次数
-            session_info = self.session_data.get(session_id, {})
+            session_info = self._get_session_info(session_id)
             unanswered_count = session_info.get("unanswered_count", 0)
+            # 记录用户最后一次发消息的时间，用于判断用户是否在本次任务执行期间回复过
+            last_msg_time = session_info.get("last_msg_time")
             logger.info(
                 f"[主动消息] 开始生成 Prompt，当前未回复次数: {unanswered_count}。"
             )
@@ -242,6 +529,10 @@ class Main(star.Star):
             original_system_prompt = ""
 
             # 这是我们从 v0.4.9 版本学到的、最可靠的人格加载逻辑
+            # 提前并行查询全局默认人格，掩盖其延迟；若最终加载到了专属人格则丢弃结果
+            default_persona_task = asyncio.create_task(
+                self.context.persona_manager.get_default_persona_v3(umo=session_id)
+            )
             try:
                 # 1. 尝试加载与当前会话绑定的专属人格
                 conv_id = (
@@ -257,7 +548,9 @@ class Main(star.Star):
                     )
                     if conversation:
                         if conversation.history:
-                            str_history = json.loads(conversation.history)
+                            str_history = self._parse_history(
+                                session_id, conv_id, conversation.history
+                            )
                         if conversation.persona_id:
                             persona = await self.context.persona_manager.get_persona(
                                 conversation.persona_id
@@ -270,11 +563,7 @@ class Main(star.Star):
 
                 # 2. 如果找不到专属人格，则加载全局默认人格作为 fallback
                 if not original_system_prompt:
-                    default_persona_v3 = (
-                        await self.context.persona_manager.get_default_persona_v3(
-                            umo=session_id
-                        )
-                    )
+                    default_persona_v3 = await default_persona_task
                     if default_persona_v3:
                         original_system_prompt = default_persona_v3["prompt"]
                         logger.info(
@@ -282,6 +571,12 @@ class Main(star.Star):
                         )
             except Exception as e:
                 logger.warning(f"[主动消息] 获取上下文失败: {e}")
+            finally:
+                # 取消未用到的查询；已完成的也取出异常，避免出现未处理异常的警告
+                if not default_persona_task.done():
+                    default_persona_task.cancel()
+                elif not default_persona_task.cancelled():
+                    default_persona_task.exception()
 
             # 如果最终还是没能加载到任何人格，则放弃本次主动聊天
             if not original_system_prompt:
@@ -298,13 +593,13 @@ class Main(star.Star):
 
             # --- 核心：构造最终的 Prompt ---
 
-            # 终局修复：从新的 "prompt_settings" 分组中读取核心配置
-            prompt_conf = self.config.get("prompt_settings", {})
-            motivation_template = prompt_conf.get("proactive_prompt", "")
             # 将动态的计数值注入模板
-            final_user_simulation_prompt = motivation_template.replace(
-                "{{unanswered_count}}", str(unanswered_count)
+            count_str = (
+                COUNT_STRS[unanswered_count]
+                if 0 <= unanswered_count < len(COUNT_STRS)
+                else str(unanswered_count)
             )
+            final_user_simulation_prompt = count_str.join(self._prompt_parts)
             logger.info("[主动消息] 已生成包含动机的 Prompt。")
 
             # --- 核心：以正确的“三分离”架构调用 LLM ---
@@ -325,21 +620,15 @@ class Main(star.Star):
                     logger.info("[主动消息] 尝试为所有语言进行手动 TTS。")
 
                     # 获取 TTS provider
-                    tts_provider_or_list = self.context.get_using_tts_provider(
-                        umo=session_id
-                    )
-                    tts_provider = (
-                        tts_provider_or_list[0]
-                        if isinstance(tts_provider_or_list, list)
-                        and tts_provider_or_list
-                        else tts_provider_or_list
-                    )
+                    tts_provider = self._get_tts_provider(session_id)
 
                     if tts_provider:
                         # 调用 TTS 服务
                         audio_path = await tts_provider.get_audio(response_text)
                         if audio_path:
-                            # 使用 MessageChain 封装语音组件
+                            # 使用 MessageChain 封装语音组件。
+                            # 注意：send_message 会把消息链交给平台适配器，部分适配器会异步持有它，
+                            # 因此每次发送都构造新的消息链，而不是复用并修改同一个对象
                             voice_chain = MessageChain([Record(file=audio_path)])
                             # 使用官方指定的 send_message API 发送
                             await self.context.send_message(session_id, voice_chain)
@@ -347,25 +636,27 @@ class Main(star.Star):
                             await asyncio.sleep(
                                 0.5
                             )  # 短暂等待，确保语音和文本消息的顺序
-                except Exception as e:
+                except Exception:
                     # 捕获所有 TTS 相关的异常，记录日志，但不会让程序崩溃
-                    logger.error(
-                        f"[主动消息] 手动 TTS 流程发生异常: {e}\n{traceback.format_exc()}"
-                    )
-                finally:
-                    # 修复：从分组后的配置中正确读取参数
-                    tts_conf = self.config.get("tts_settings", {})
-                    # 无论 TTS 是否成功，都根据配置决定是否发送原文
-                    if not is_tts_sent or tts_conf.get("always_send_text", True):
-                        text_chain = MessageChain([Plain(text=response_text)])
-                        await self.context.send_message(session_id, text_chain)
-                    logger.info(f"[主动消息] 成功！所有消息已发送至 '{session_id}'。")
+                    # 同时丢弃缓存的 Provider，下次重新获取
+                    self._tts_cache.pop(session_id, None)
+                    # logger.exception 会自动附带堆栈，且只在日志实际输出时才格式化
+                    logger.exception("[主动消息] 手动 TTS 流程发生异常")
+
+                # 无论 TTS 是否成功，都根据配置决定是否发送原文。
+                # 不放在 finally 中：任务被取消时不应再发送任何消息
+                if not is_tts_sent or self._always_send_text:
+                    text_chain = MessageChain([Plain(text=response_text)])
+                    await self.context.send_message(session_id, text_chain)
+                logger.info(f"[主动消息] 成功！所有消息已发送至 '{session_id}'。")
 
                 # --- 核心：修正计数器逻辑 ---
+                # 如果用户在本次任务执行期间回复过，计数器已被重置、下一次任务也已安排，无需再处理
+                if session_info.get("last_msg_time") != last_msg_time:
+                    logger.info("[主动消息] 用户在任务执行期间已回复，保留重置后的计数。")
+                    return
                 # 成功发送后，将计数值+1
-                self.session_data.setdefault(session_id, {})["unanswered_count"] = (
-                    unanswered_count + 1
-                )
+                session_info["unanswered_count"] = unanswered_count + 1
                 logger.info(
                     f"[主动消息] 任务成功，未回复次数更新为: {unanswered_count + 1}。"
                 )
@@ -373,18 +664,41 @@ class Main(star.Star):
             else:
                 logger.warning("[主动消息] LLM 调用失败或返回空内容，重新调度。")
                 await self._schedule_next_chat(session_id)
-        except Exception as e:
-            logger.error(
-                f"[主动消息] check_and_chat 任务发生致命错误: {e}\n{traceback.format_exc()}"
-            )
+        except Exception:
+            logger.exception("[主动消息] check_and_chat 任务发生致命错误")
             await self._schedule_next_chat(session_id)
 
     async def terminate(self):
         """
         插件被卸载或停用时调用的清理函数。
         """
-        if self.scheduler and self.scheduler.running:
-            self.scheduler.shutdown()
-        save_session_data_to_file(self.session_data)
+        # 正在执行的主动聊天不直接取消，先等待它们在限定时间内完成，超时后才取消
+        if self._running_tasks:
+            _, pending = await asyncio.wait(
+                set(self._running_tasks), timeout=SHUTDOWN_WAIT_TIMEOUT
+            )
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        # 等待期间完成的主动聊天会重新调度，因此最后再取消所有仍在等待中的任务
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        if self._flush_task:
+            self._flush_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flush_task
+        # 等待正在进行的后台写盘结束，保证最终写盘排在它之后
+        if self._pending_write:
+            await self._pending_write
+        # 强制落盘，确保最后一个合并间隔内的修改 (包括未达到写盘阈值的微小变化) 不会丢失。
+        # 此时事件循环即将关闭，直接同步写入即可
+        save_sessions_to_file(
+            {
+                session_id: session_info
+                for session_id, session_info in self.session_data.items()
+                if session_info != self._saved_snapshots.get(session_id)
+            }
+        )
         logger.info("主动消息插件已终止。")
 